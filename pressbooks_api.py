@@ -18,26 +18,139 @@ Configuration:
 """
 
 import os
+import re
 import sys
 import json
 import getpass
+import hashlib
+import logging
+import functools
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # optional speedup; the stdlib json module works fine
+    orjson = None
+
+# Progress goes to stdout whether this runs as a script or is imported.
+log = logging.getLogger("pressbooks")
+_LOG_HANDLER = logging.StreamHandler(sys.stdout)
+_LOG_HANDLER.setFormatter(logging.Formatter("%(message)s"))
+log.addHandler(_LOG_HANDLER)
+log.setLevel(logging.INFO)
+log.propagate = False
 
 SCRIPT_DIR = Path(__file__).resolve().parent
 ENV_FILE = SCRIPT_DIR / ".env"
+# KEY=value lines; blank lines and # comments never match.
+ENV_LINE = re.compile(r"^[ \t]*([^#=\s][^=\n]*?)[ \t]*=(.*)$", re.MULTILINE)
+
+# pull-all is bound by network round-trips, so fetch several items at once.
+PULL_WORKERS = 16
+
+# pull-all reads whole collections a page at a time; 100 is the WordPress
+# REST API maximum for per_page.
+LIST_PAGE_SIZE = 100
+
+# Maps content IDs to local HTML filenames so push can find a file without
+# scanning the book folder. Lives next to the pulled files.
+LOCAL_INDEX_NAME = "index.json"
+_LOCAL_INDEX_LOCK = threading.Lock()
+
+# Ask WordPress to return only the fields this script reads (via _fields),
+# rather than full objects with _links, excerpts and custom meta.
+CONTENT_FIELDS = "id,slug,title,content,status,link"
+TOC_FIELDS = "front-matter,parts,back-matter"
+
+# Sessions are shared across calls, so connections (and TLS handshakes) are
+# reused instead of being rebuilt for every request.
+#
+# Transient server errors and rate limits on GETs are retried with
+# exponential backoff (honouring Retry-After), so one hiccup doesn't abort
+# a long pull-all. POSTs are never retried: a push that timed out may
+# already have been applied.
+_RETRY = Retry(
+    total=5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods={"GET"},
+    backoff_factor=0.5,
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+_ADAPTER = HTTPAdapter(
+    pool_connections=PULL_WORKERS,
+    pool_maxsize=PULL_WORKERS,
+    max_retries=_RETRY,
+)
+
+
+def _new_session():
+    session = requests.Session()
+    session.headers.update({"User-Agent": "pressbooks-cli"})
+    session.mount("https://", _ADAPTER)
+    session.mount("http://", _ADAPTER)
+    return session
+
+
+# Reads are anonymous; writes go through _authed_session().
+_SESSION = _new_session()
+
+
+def load_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_json(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=1)
+def read_env_file(mtime_ns):
+    # Keyed on the file's mtime so repeated load_env() calls in one process
+    # only re-parse .env after it has been edited.
+    env = {}
+    for key, value in ENV_LINE.findall(ENV_FILE.read_text()):
+        # First occurrence wins, matching os.environ.setdefault per line.
+        env.setdefault(key, value.strip())
+    return env
 
 
 def load_env():
-    if ENV_FILE.exists():
-        for line in ENV_FILE.read_text().splitlines():
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ.setdefault(key.strip(), value.strip())
+    try:
+        mtime_ns = ENV_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
+        return
+    for key, value in read_env_file(mtime_ns).items():
+        os.environ.setdefault(key, value)
 
 
+@dataclass(frozen=True)
+class Config:
+    book_url: str
+    api_base: str
+    chapters_dir: Path
+    slug: str
+    toc_url: str
+
+    def collection_url(self, endpoint):
+        return f"{self.api_base}/{endpoint}"
+
+    def item_url(self, endpoint, content_id):
+        return f"{self.api_base}/{endpoint}/{content_id}"
+
+
+@functools.lru_cache(maxsize=1)
 def get_config():
     book_url = os.environ.get("PRESSBOOKS_URL")
     if not book_url:
@@ -50,12 +163,14 @@ def get_config():
     # Single-book domains can have no path (e.g., https://book.example.edu/).
     # Fall back to the hostname so local chapter files stay namespaced.
     slug = path_slug or (parsed.netloc.split(":")[0] if parsed.netloc else "pressbooks-book")
-    return {
-        "book_url": book_url,
-        "api_base": f"{book_url}/wp-json/pressbooks/v2",
-        "chapters_dir": SCRIPT_DIR / slug,
-        "slug": slug,
-    }
+    api_base = f"{book_url}/wp-json/pressbooks/v2"
+    return Config(
+        book_url=book_url,
+        api_base=api_base,
+        chapters_dir=SCRIPT_DIR / slug,
+        slug=slug,
+        toc_url=f"{api_base}/toc",
+    )
 
 
 def get_auth():
@@ -69,11 +184,20 @@ def get_auth():
     return (user, password)
 
 
+@functools.lru_cache(maxsize=1)
+def _authed_session():
+    # Credentials are resolved (and prompted for) once, then sent with every
+    # write made through this session.
+    session = _new_session()
+    session.auth = get_auth()
+    return session
+
+
 def get_toc():
     cfg = get_config()
-    toc = fetch_toc(cfg)
+    toc = fetch_toc()
 
-    print(f"\n=== {cfg['slug']} — Table of Contents ===\n")
+    print(f"\n=== {cfg.slug} — Table of Contents ===\n")
 
     if toc.get("front-matter"):
         print("Front Matter:")
@@ -95,29 +219,33 @@ def get_toc():
         print()
 
 
-def fetch_toc(cfg=None):
-    if cfg is None:
-        cfg = get_config()
-    r = requests.get(f"{cfg['api_base']}/toc")
+@functools.lru_cache(maxsize=1)
+def fetch_toc():
+    cfg = get_config()
+    r = _SESSION.get(cfg.toc_url, params={"_fields": TOC_FIELDS})
     r.raise_for_status()
-    return r.json()
+    return load_json(r.content)
 
 
-def endpoint_from_toc_id(content_id, toc):
+def build_endpoint_index(toc):
+    index = {}
     for item in toc.get("front-matter", []):
-        if item.get("id") == content_id:
-            return "front-matter"
-
+        index[item["id"]] = "front-matter"
     for part in toc.get("parts", []):
         for item in part.get("chapters", []):
-            if item.get("id") == content_id:
-                return "chapters"
-
+            index[item["id"]] = "chapters"
     for item in toc.get("back-matter", []):
-        if item.get("id") == content_id:
-            return "back-matter"
+        index[item["id"]] = "back-matter"
+    return index
 
-    return None
+
+@functools.lru_cache(maxsize=1)
+def fetch_endpoint_index():
+    return build_endpoint_index(fetch_toc())
+
+
+def endpoint_from_toc_id(content_id):
+    return fetch_endpoint_index().get(content_id)
 
 
 def endpoint_label(endpoint):
@@ -130,25 +258,101 @@ def endpoint_label(endpoint):
     return "content"
 
 
-def pull_chapter(content_id, auth=None):
+def read_local_index(cfg):
+    try:
+        return load_json((cfg.chapters_dir / LOCAL_INDEX_NAME).read_bytes())
+    except FileNotFoundError:
+        return {}
+
+
+def update_local_index(cfg, filepaths):
+    with _LOCAL_INDEX_LOCK:
+        index = read_local_index(cfg)
+        for content_id, filepath in filepaths.items():
+            index[str(content_id)] = filepath.name
+        index_path = cfg.chapters_dir / LOCAL_INDEX_NAME
+        tmp_path = index_path.with_name(f"{LOCAL_INDEX_NAME}.tmp")
+        tmp_path.write_bytes(dump_json(index))
+        os.replace(tmp_path, index_path)
+
+
+def find_local_file(cfg, content_id):
+    filename = read_local_index(cfg).get(str(content_id))
+    if filename and (cfg.chapters_dir / filename).exists():
+        return cfg.chapters_dir / filename
+    # Folders pulled before index.json existed
+    for filepath in cfg.chapters_dir.glob(f"{content_id}_*.html"):
+        return filepath
+    return None
+
+
+def content_sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_local_meta(cfg, content_id):
+    filepath = find_local_file(cfg, content_id)
+    if filepath is not None:
+        meta_path = filepath.with_suffix(".json")
+        if meta_path.exists():
+            return filepath, load_json(meta_path.read_bytes())
+    return None, None
+
+
+def pull_chapter(content_id, endpoint=None, auth=None):
     cfg = get_config()
-    toc = fetch_toc(cfg)
-    endpoint = endpoint_from_toc_id(content_id, toc)
+    if endpoint is None:
+        endpoint = endpoint_from_toc_id(content_id)
     if endpoint is None:
         print(f"Error: ID {content_id} was not found in the table of contents.")
         sys.exit(1)
 
-    r = requests.get(f"{cfg['api_base']}/{endpoint}/{content_id}")
+    # Replay the validators from the last pull so the server can answer
+    # 304 Not Modified instead of resending an unchanged item. Only do this
+    # while neither the HTML nor the title has been edited locally, so a pull
+    # still restores the server version over local changes.
+    headers = {}
+    html_path, meta = read_local_meta(cfg, content_id)
+    if (
+        meta
+        and (meta.get("etag") or meta.get("last_modified"))
+        and meta.get("title") == meta.get("remote_title")
+        and meta.get("sha256") == content_sha256(html_path.read_bytes())
+    ):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    r = _SESSION.get(
+        cfg.item_url(endpoint, content_id),
+        params={"_fields": CONTENT_FIELDS},
+        headers=headers,
+    )
+    if r.status_code == 304:
+        log.info(f"Unchanged {endpoint_label(endpoint)}: [{content_id}] {meta.get('title')}")
+        return html_path
     r.raise_for_status()
-    chapter = r.json()
+    chapter, response_headers = load_json(r.content), r.headers
+    # Drop the raw body before writing, so a long chapter isn't held in
+    # memory as bytes, parsed JSON and file content all at once.
+    del r
+    cfg.chapters_dir.mkdir(parents=True, exist_ok=True)
+    filepath = save_item(cfg, content_id, endpoint, chapter, response_headers)
+    update_local_index(cfg, {content_id: filepath})
+    return filepath
+
 
+def save_item(cfg, content_id, endpoint, chapter, headers=None):
+    if headers is None:
+        headers = {}
     title = chapter["title"]["rendered"]
-    content = chapter["content"]["rendered"]
+    # Encode once; the same bytes are written and hashed.
+    content_bytes = chapter["content"]["rendered"].encode("utf-8")
     slug = chapter.get("slug", f"content-{content_id}")
 
-    cfg["chapters_dir"].mkdir(parents=True, exist_ok=True)
-    filepath = cfg["chapters_dir"] / f"{content_id}_{slug}.html"
-    filepath.write_text(content, encoding="utf-8")
+    filepath = cfg.chapters_dir / f"{content_id}_{slug}.html"
+    filepath.write_bytes(content_bytes)
 
     # Save metadata alongside
     meta = {
@@ -158,58 +362,71 @@ def pull_chapter(content_id, auth=None):
         "slug": slug,
         "status": chapter.get("status"),
         "link": chapter.get("link"),
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        # What the server had at pull time, so push can skip unedited items.
+        "sha256": content_sha256(content_bytes),
+        "remote_title": title,
     }
-    meta_path = cfg["chapters_dir"] / f"{content_id}_{slug}.json"
-    meta_path.write_text(json.dumps(meta, indent=2), encoding="utf-8")
-
-    print(f"Pulled {endpoint_label(endpoint)}: [{content_id}] {title}")
-    print(f"  HTML: {filepath}")
-    print(f"  Meta: {meta_path}")
+    meta_path = cfg.chapters_dir / f"{content_id}_{slug}.json"
+    meta_path.write_bytes(dump_json(meta))
+
+    # One record per item keeps its lines together when pull-all runs in
+    # threads.
+    log.info(
+        f"Pulled {endpoint_label(endpoint)}: [{content_id}] {title}\n"
+        f"  HTML: {filepath}\n"
+        f"  Meta: {meta_path}"
+    )
     return filepath
 
 
 def push_chapter(content_id, auth=None):
     cfg = get_config()
-    if auth is None:
-        auth = get_auth()
 
     # Find the local HTML file
-    matches = list(cfg["chapters_dir"].glob(f"{content_id}_*.html"))
-    if not matches:
+    filepath = find_local_file(cfg, content_id)
+    if filepath is None:
         print(f"Error: No local file found for content ID {content_id}")
         print(f"  Run 'pull {content_id}' first.")
         sys.exit(1)
 
-    filepath = matches[0]
-    content = filepath.read_text(encoding="utf-8")
+    content_bytes = filepath.read_bytes()
+    digest = content_sha256(content_bytes)
 
     # Load metadata for title
     meta_path = filepath.with_suffix(".json")
+    meta = {}
     title = None
     endpoint = None
     if meta_path.exists():
-        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        meta = load_json(meta_path.read_bytes())
         title = meta.get("title")
         endpoint = meta.get("type")
 
+    if meta.get("sha256") == digest and title == meta.get("remote_title"):
+        log.info(f"No changes for [{content_id}]; skipping push")
+        return
+
     if endpoint not in {"chapters", "front-matter", "back-matter"}:
-        toc = fetch_toc(cfg)
-        endpoint = endpoint_from_toc_id(content_id, toc)
+        endpoint = endpoint_from_toc_id(content_id)
 
     if endpoint is None:
         print(f"Error: Could not determine content type for ID {content_id}.")
         print("  Pull the item again so metadata includes its type.")
         sys.exit(1)
 
+    session = _authed_session() if auth is None else _SESSION
+
+    # The skip check above hashes the raw bytes; what gets sent has its line
+    # endings normalized the way read_text() did, so CRLF files (older
+    # Windows pulls, editors saving CRLF) don't push literal \r\n.
+    content = content_bytes.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
     data = {"content": content}
     if title:
         data["title"] = title
 
-    r = requests.post(
-        f"{cfg['api_base']}/{endpoint}/{content_id}",
-        json=data,
-        auth=auth,
-    )
+    r = session.post(cfg.item_url(endpoint, content_id), json=data, auth=auth)
 
     if r.status_code == 401:
         print("Error: Authentication failed.")
@@ -221,29 +438,62 @@ def push_chapter(content_id, auth=None):
         sys.exit(1)
 
     r.raise_for_status()
-    result = r.json()
-    print(f"Pushed {endpoint_label(endpoint)}: [{content_id}] {result['title']['rendered']}")
-    print(f"  Status: {result.get('status')}")
-    print(f"  Link: {result.get('link')}")
+    result = load_json(r.content)
+    if meta:
+        meta["sha256"] = digest
+        meta["remote_title"] = title
+        meta_path.write_bytes(dump_json(meta))
+    log.info(
+        f"Pushed {endpoint_label(endpoint)}: [{content_id}] {result['title']['rendered']}\n"
+        f"  Status: {result.get('status')}\n"
+        f"  Link: {result.get('link')}"
+    )
 
 
-def pull_all():
+def iter_collection(endpoint):
     cfg = get_config()
-    toc = fetch_toc(cfg)
+    page = 1
+    while True:
+        r = _SESSION.get(
+            cfg.collection_url(endpoint),
+            params={"per_page": LIST_PAGE_SIZE, "page": page, "_fields": CONTENT_FIELDS},
+        )
+        r.raise_for_status()
+        batch = load_json(r.content)
+        total_pages = int(r.headers.get("X-WP-TotalPages", page + 1))
+        # Free the raw page body while its items are being written.
+        del r
+        yield from batch
+        if len(batch) < LIST_PAGE_SIZE or page >= total_pages:
+            return
+        page += 1
 
-    content_ids = []
-    for item in toc.get("front-matter", []):
-        content_ids.append(item["id"])
-    for part in toc.get("parts", []):
-        for ch in part.get("chapters", []):
-            content_ids.append(ch["id"])
-    for item in toc.get("back-matter", []):
-        content_ids.append(item["id"])
 
-    print(f"Pulling {len(content_ids)} items (front matter, chapters, back matter)...\n")
-    for cid in content_ids:
-        pull_chapter(cid)
-    print(f"\nDone. Files saved to: {cfg['chapters_dir']}")
+def pull_all():
+    cfg = get_config()
+    pending = dict(fetch_endpoint_index())
+
+    log.info(f"Pulling {len(pending)} items (front matter, chapters, back matter)...\n")
+    cfg.chapters_dir.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=PULL_WORKERS) as pool:
+        # Listed items are written to disk on the pool while the next page
+        # is still downloading.
+        futures = {}
+        for endpoint in ("front-matter", "chapters", "back-matter"):
+            if endpoint not in pending.values():
+                continue
+            for item in iter_collection(endpoint):
+                if pending.get(item["id"]) == endpoint:
+                    del pending[item["id"]]
+                    futures[item["id"]] = pool.submit(save_item, cfg, item["id"], endpoint, item)
+
+        # Anything the list endpoints did not return (e.g. drafts) is fetched
+        # individually.
+        for cid, endpoint in pending.items():
+            futures[cid] = pool.submit(pull_chapter, cid, endpoint)
+        filepaths = {cid: future.result() for cid, future in futures.items()}
+    update_local_index(cfg, filepaths)
+    log.info(f"\nDone. Files saved to: {cfg.chapters_dir}")
 
 
 def main():